@@ -11,7 +11,7 @@ from utils import padding_idx
 #결측치 처리
 def load_fake_features():
     feats = torch.rand(1, 32, 1024)[0]
-    img_mask = torch.rand(1, 32).bool()
+    img_mask = torch.rand(1, 1, 32).bool()
     classe = np.array([72, 33,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0])
     final_classes = torch.Tensor(classe).long()
     return feats, img_mask, final_classes
@@ -34,7 +34,7 @@ def load_video_features(fpath, max_length, classes):
         final_classes = torch.from_numpy(final_classes)
         img = torch.from_numpy(np.float32(feats))
         # img_mask
-        img_mask = (torch.sum(img != 1, dim=1) != 0).unsqueeze(-2)
+        img_mask = (torch.sum(img != 1, dim=1) != 0).unsqueeze(-2).unsqueeze(-2)
         img = img * img_mask.squeeze().unsqueeze(-1).expand_as(img).long()
 
         return img, img_mask, final_classes
@@ -48,7 +48,7 @@ def load_video_features(fpath, max_length, classes):
         
         img = torch.from_numpy(np.float32(feats))
         # img_mask
-        img_mask = (torch.sum(img != 1, dim=1) != 0).unsqueeze(-2)
+        img_mask = (torch.sum(img != 1, dim=1) != 0).unsqueeze(-2).unsqueeze(-2)
         img = img * img_mask.squeeze().unsqueeze(-1).expand_as(img).long()
 
         return img, img_mask, final_classes
@@ -4,7 +4,6 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.utils.weight_norm import weight_norm
 import math, copy, time
-from torch.autograd import Variable
 
 
 class EncoderDecoder(nn.Module):
@@ -25,10 +24,20 @@ class EncoderDecoder(nn.Module):
 
 
     def forward(self, en, ensrc_mask, entgt_mask, zh, zhsrc_mask, zhtgt_mask, video, video_mask):
-        en_encoded, en_act_pred = self.encode(en, ensrc_mask, video, video_mask)
+        # Normalize every mask to boolean once here instead of evaluating
+        # `mask == 0` inside each of the ~30 attention calls per step.
+        ensrc_mask, entgt_mask = ensrc_mask != 0, entgt_mask != 0
+        zhsrc_mask, zhtgt_mask = zhsrc_mask != 0, zhtgt_mask != 0
+        video_mask = video_mask != 0
+
+        # the video tensor is identical for both directions, so run the video
+        # encoder once per step instead of once per encode call
+        vid_enc = self.vid_encode(video)
+
+        en_encoded, en_act_pred = self.encode(en, ensrc_mask, video, video_mask, vid_enc=vid_enc)
         en_decoded = self.decode(en_encoded, ensrc_mask, zh[:, :-1], zhtgt_mask)
 
-        zh_encoded, zh_act_pred = self.encode(zh, zhsrc_mask, video, video_mask, type='zh2en')
+        zh_encoded, zh_act_pred = self.encode(zh, zhsrc_mask, video, video_mask, type='zh2en', vid_enc=vid_enc)
         zh_decoded = self.decode(zh_encoded, zhsrc_mask, en[:, :-1], entgt_mask, type='zh2en')
         return en_decoded, zh_decoded, en_act_pred, zh_act_pred
 
@@ -36,13 +45,38 @@ class EncoderDecoder(nn.Module):
         output = self.vid_encoder(video_features)
         return output
 
-    def encode(self, query, query_mask, video, video_mask, type='en2zh'):
+    def encode(self, query, query_mask, video, video_mask, type='en2zh', vid_enc=None):
+        # resolve the direction to an int once; the layers below never
+        # dispatch on a Python string
+        direction = 0 if type == 'en2zh' else 1
+        if vid_enc is None:
+            vid_enc = self.vid_encode(video)
         if type == 'en2zh':
-            output = self.encoder(self.en_embed(query), query_mask, self.vid_encode(video), video_mask, type)
+            output = self.encoder(self.en_embed(query), query_mask, vid_enc, video_mask, direction)
         else:
-            output = self.encoder(self.zh_embed(query), query_mask, self.vid_encode(video), video_mask, type)
+            output = self.encoder(self.zh_embed(query), query_mask, vid_enc, video_mask, direction)
         return output
 
+    def encode_once(self, src, src_mask, video, video_mask, type='en2zh'):
+        "Encode the source once so a generate loop can cache the memory."
+        memory, _ = self.encode(src, src_mask, video, video_mask, type)
+        return memory, src_mask
+
+    def decode_step(self, memory, src_mask, tgt_tokens, tgt_mask, type='en2zh', past_kvs=None, use_cache=False):
+        "Run one decoding step against a cached encoder memory."
+        if use_cache:
+            if type == 'en2zh':
+                encoded_tgt = self.zh_embed(tgt_tokens)
+            else:
+                encoded_tgt = self.en_embed(tgt_tokens)
+            if past_kvs is not None:
+                # earlier positions live in the cached K/V, so only the newest
+                # token runs through the decoder; the causal mask is implied
+                encoded_tgt = encoded_tgt[:, -1:]
+                tgt_mask = None
+            return self.decoder(encoded_tgt, memory, src_mask, tgt_mask, past_kvs=past_kvs, use_cache=True)
+        return self.decode(memory, src_mask, tgt_tokens, tgt_mask, type)
+
     def decode(self, query_memory, query_mask, tgt, tgt_mask, type='en2zh'):
         if type == 'en2zh':
             encoded_tgt = self.zh_embed(tgt)
@@ -78,26 +112,18 @@ class Encoder(nn.Module):
         self.layers = clones(layer, N)
         self.norm = LayerNorm(layer.size)
 
-    def forward(self, x, mask, video, video_mask, type):
+    def forward(self, x, mask, video, video_mask, direction):
         "Pass the input (and mask) through each layer in turn."
         for layer in self.layers:
-            x, act_pred = layer(x, mask, video, video_mask, type)
+            x, act_pred = layer(x, mask, video, video_mask, direction)
         return self.norm(x), act_pred
 
 
-class LayerNorm(nn.Module):
-    "Construct a layernorm module"
+class LayerNorm(nn.LayerNorm):
+    "Layernorm backed by the fused aten kernel, keeping the transformer eps."
 
     def __init__(self, features, eps=1e-6):
-        super(LayerNorm, self).__init__()
-        self.a_2 = nn.Parameter(torch.ones(features))
-        self.b_2 = nn.Parameter(torch.zeros(features))
-        self.eps = eps
-
-    def forward(self, x):
-        mean = x.mean(-1, keepdim=True)
-        std = x.std(-1, keepdim=True)
-        return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
+        super(LayerNorm, self).__init__(features, eps=eps)
 
 
 class SublayerConnection(nn.Module):
@@ -115,14 +141,37 @@ class SublayerConnection(nn.Module):
         return x + self.dropout(sublayer(self.norm(x)))
 
     def expand_forward(self, x, sublayer):
-        out = self.dropout(sublayer(self.norm(x)))
-        out = out.mean(1).unsqueeze(1).expand_as(x)
+        # (B, 1, C) broadcasts against x in the add; expand_as only forced
+        # the intermediate to be materialized at full (B, N, C) size
+        out = self.dropout(sublayer(self.norm(x))).mean(1, keepdim=True)
         return x + out
 
     def nosum_forward(self, x, sublayer):
         return self.dropout(sublayer(self.norm(x)))
 
 
+class ActionClassifier(nn.Module):
+    "Per-direction action classifiers stacked into one weight tensor."
+
+    def __init__(self, d_model, n_actions, n_directions=2):
+        super(ActionClassifier, self).__init__()
+        # one (n_directions, n_actions, d_model) parameter instead of a dict
+        # of per-direction Linear modules: single allocation, single device
+        # copy, and it is registered on the model like any other parameter
+        self.weight = nn.Parameter(torch.empty(n_directions, n_actions, d_model))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # xavier each (n_actions, d_model) slice on its own: run over the
+        # stacked 3-D weight the fan rule would shrink the bounds well below
+        # the per-direction Linear init this module replaces
+        for d in range(self.weight.size(0)):
+            nn.init.xavier_uniform_(self.weight[d])
+
+    def forward(self, x, direction):
+        return F.linear(x, self.weight[direction])
+
+
 class EncoderLayer(nn.Module):
     def __init__(self, size, self_attn, vid_attn, ff1, dropout, seq_attn=None, ff2=None, classifier=None):
         super(EncoderLayer, self).__init__()
@@ -136,22 +185,29 @@ class EncoderLayer(nn.Module):
 
         self.classifier = classifier
 
-    def forward(self, seq, seq_mask, video, video_mask, type):
-        seq = self.sublayer[0](seq, lambda seq: self.self_attn(seq, seq, seq, seq_mask))
-        vid_seq = self.sublayer[1](seq, lambda seq: self.vid_attn(seq, video, video, video_mask))
-
-        seq_vid = self.sublayer[2](video, lambda video: self.seq_attn(video, seq, seq, seq_mask))
-        seq_vid = self.sublayer[3](seq_vid, self.ff2)
-
-        if isinstance(self.classifier, dict):
-            if type == 'en2zh':
-                act_pred = F.log_softmax(self.classifier['en'](seq_vid), dim=-1)
-            else:
-                act_pred = F.log_softmax(self.classifier['zh'](seq_vid), dim=-1)
+    def forward(self, seq, seq_mask, video, video_mask, direction):
+        # bind the sublayers once; ModuleList.__getitem__ costs add up at
+        # five lookups per layer per step
+        sub0, sub1, sub2, sub3, sub4 = self.sublayer
+        # residuals are written out instead of handing lambdas to the
+        # sublayer: no closure allocation per call, and both torch.compile
+        # and TorchScript can see through the calls
+        h = sub0.norm(seq)
+        seq = seq + sub0.dropout(self.self_attn(h, h, h, seq_mask))
+
+        h = sub1.norm(seq)
+        vid_seq = seq + sub1.dropout(self.vid_attn(h, video, video, video_mask))
+
+        h = sub2.norm(video)
+        seq_vid = video + sub2.dropout(self.seq_attn(h, seq, seq, seq_mask))
+        seq_vid = sub3(seq_vid, self.ff2)
+
+        if isinstance(self.classifier, ActionClassifier):
+            act_pred = F.log_softmax(self.classifier(seq_vid, direction), dim=-1)
         else:
-            act_pred = F.log_softmax(self.classifier(seq_vid))
+            act_pred = F.log_softmax(self.classifier(seq_vid), dim=-1)
 
-        return self.sublayer[4](vid_seq, self.ff1), act_pred
+        return sub4(vid_seq, self.ff1), act_pred
 
 
 class Decoder(nn.Module):
@@ -160,7 +216,14 @@ class Decoder(nn.Module):
         self.layers = clones(layer, N)
         self.norm = LayerNorm(layer.size)
 
-    def forward(self, x, query_memory, query_mask, tgt_mask):
+    def forward(self, x, query_memory, query_mask, tgt_mask, past_kvs=None, use_cache=False):
+        if use_cache:
+            presents = []
+            for i, layer in enumerate(self.layers):
+                past = past_kvs[i] if past_kvs is not None else None
+                x, present = layer(x, query_memory, query_mask, tgt_mask, past_kv=past, use_cache=True)
+                presents.append(present)
+            return self.norm(x), presents
         for layer in self.layers:
             x = layer(x, query_memory, query_mask, tgt_mask)
         return self.norm(x)
@@ -175,21 +238,40 @@ class DecoderLayer(nn.Module):
         self.feed_forward = feed_forward
         self.sublayer = clones(SublayerConnection(size, dropout), 3)
 
-    def forward(self, x, q_memory, q_mask, tgt_mask):
-        count = 0
-        x = self.sublayer[count](x, lambda x: self.self_attn(x, x, x, tgt_mask))
-        count += 1
-        x = self.sublayer[count](x, lambda x: self.src_attn(x, q_memory, q_memory, q_mask))
-        count += 1
-        return self.sublayer[count](x, self.feed_forward)
+    def forward(self, x, q_memory, q_mask, tgt_mask, past_kv=None, use_cache=False):
+        sub0, sub1, sub2 = self.sublayer
+        if use_cache:
+            self_past = past_kv[0] if past_kv is not None else None
+            src_past = past_kv[1] if past_kv is not None else None
+
+            h = sub0.norm(x)
+            out, self_present = self.self_attn(h, h, h, tgt_mask, cache=self_past, use_cache=True)
+            x = x + sub0.dropout(out)
+
+            h = sub1.norm(x)
+            out, src_present = self.src_attn(h, q_memory, q_memory, q_mask, cache=src_past, use_cache=True)
+            x = x + sub1.dropout(out)
+
+            return sub2(x, self.feed_forward), (self_present, src_present)
 
+        h = sub0.norm(x)
+        x = x + sub0.dropout(self.self_attn(h, h, h, tgt_mask))
+        h = sub1.norm(x)
+        x = x + sub1.dropout(self.src_attn(h, q_memory, q_memory, q_mask))
+        return sub2(x, self.feed_forward)
 
-def attention(query, key, value, mask=None, dropout=None):
+
+def attention(query, key, value, mask=None, dropout=None, scale=None, neg_inf=None):
     "Compute 'Scaled Dot Product Attention'"
-    d_k = query.size(-1)
-    scores = torch.matmul(query, key.transpose(-2, -1)) / math.sqrt(d_k)
+    if scale is None:
+        scale = 1.0 / math.sqrt(query.size(-1))
+    scores = torch.matmul(query, key.transpose(-2, -1)).mul_(scale)
     if mask is not None:
-        scores = scores.masked_fill(mask == 0, -1e9)
+        # mask is already boolean (True = attend); fill in place so no fresh
+        # score tensor is allocated
+        if neg_inf is None:
+            neg_inf = scores.new_tensor(-1e9)
+        scores.masked_fill_(~mask, neg_inf)
     p_attn = F.softmax(scores, dim=-1)
 
     if dropout is not None:
@@ -206,29 +288,88 @@ class MultiHeadedAttention(nn.Module):
         self.d_k = d_model // h
         self.d_model = d_model
         self.h = h
+        # hoisted out of the per-call path; sqrt is cheap but this also keeps
+        # the eager fallback free of python-float churn inside the hot loop
+        self.inv_sqrt_dk = 1.0 / math.sqrt(self.d_k)
         if d_in < 0:
             d_in = d_model
-        self.linears = clones(nn.Linear(d_in, d_model), 3)
-        self.linears.append(nn.Linear(d_model, d_in))
+        # fused projection for self-attn; separate q and fused kv for cross-attn
+        self.qkv = nn.Linear(d_in, 3 * d_model)
+        self.q = nn.Linear(d_in, d_model)
+        self.kv = nn.Linear(d_in, 2 * d_model)
+        self.out = nn.Linear(d_model, d_in)
         self.attn = None
         self.dropout = nn.Dropout(p=dropout)
+        # scalar fill value for masked scores, allocated once and moved with
+        # the module instead of being rebuilt from the python float per call;
+        # kept at -1e9 (not -inf) so fully-masked rows still softmax to a
+        # uniform distribution instead of NaN
+        self.register_buffer('neg_inf', torch.tensor(-1e9), persistent=False)
 
-    def forward(self, query, key, value, mask=None):
+    def forward(self, query, key, value, mask=None, cache=None, use_cache=False):
         "Implements Figure 2"
         if mask is not None:
-            # Same mask applied to all h heads.
-            mask = mask.unsqueeze(1)
+            # Masks arrive from the loader already in broadcast shape,
+            # (B, 1, 1, N) or (B, 1, N, N); callers that bypass
+            # EncoderDecoder.forward may still hand us a 0/1 mask, so
+            # normalize to boolean here at most once.
+            if mask.dtype != torch.bool:
+                mask = mask != 0
         nbatches, qT, qC = query.size()
 
-        query, key, value = \
-            [l(x).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
-             for l, x in zip(self.linears, (query, key, value))]
-
-        x, self.attn = attention(query, key, value, mask=mask, dropout=self.dropout)
+        # 1) Do all the linear projections in batch from d_model => h x d_k.
+        # Self-attention projects q/k/v with one big GEMM; cross-attn (key is
+        # always value at our call sites) fuses only the k/v projections.
+        present = None
+        if key is query and value is query:
+            qkv = self.qkv(query).view(nbatches, -1, 3, self.h, self.d_k).permute(2, 0, 3, 1, 4)
+            query, key, value = qkv[0], qkv[1], qkv[2]
+            if use_cache:
+                if cache is not None:
+                    # append the new positions' K/V to the cached prefix
+                    key = torch.cat([cache[0], key], dim=2)
+                    value = torch.cat([cache[1], value], dim=2)
+                present = (key, value)
+        elif use_cache and cache is not None:
+            # cross-attention K/V are static across decode steps
+            query = self.q(query).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
+            key, value = cache
+            present = cache
+        else:
+            query = self.q(query).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
+            key, value = [t.view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
+                          for t in self.kv(key).chunk(2, dim=-1)]
+            if use_cache:
+                present = (key, value)
+
+        # 2) Apply attention on all the projected vectors in batch. On CUDA
+        # this dispatches to the fused flash/mem-efficient kernels and never
+        # materializes the (B, h, N, N) score matrix; the eager attention()
+        # path is kept for CPU eval and still records self.attn.
+        if query.is_cuda:
+            # hand SDPA an additive float mask rather than the raw bool one:
+            # a bool mask fills dropped positions with -inf, which turns a
+            # fully-masked row (the encoding path emits all-zero masks) into
+            # NaN, while -1e9 softmaxes it to uniform like the eager path
+            attn_mask = None
+            if mask is not None:
+                attn_mask = torch.zeros_like(mask, dtype=query.dtype)
+                attn_mask.masked_fill_(~mask, self.neg_inf)
+            x = F.scaled_dot_product_attention(
+                query, key, value,
+                attn_mask=attn_mask,
+                dropout_p=self.dropout.p if self.training else 0.0)
+        else:
+            x, self.attn = attention(query, key, value, mask=mask, dropout=self.dropout, scale=self.inv_sqrt_dk, neg_inf=self.neg_inf)
 
-        x = x.transpose(1, 2).contiguous() \
-            .view(nbatches, -1, self.h * self.d_k)
-        return self.linears[-1](x)
+        # 3) Project straight out of the (B, h, N, d_k) layout: einsum with a
+        # head-split view of the output weight replaces transpose+contiguous
+        # (a full copy of the attention output) followed by the Linear.
+        x = torch.einsum('bhnd,ehd->bne',
+                         x, self.out.weight.view(-1, self.h, self.d_k)) + self.out.bias
+        if use_cache:
+            return x, present
+        return x
 
 
 class PositionwiseFeedForward(nn.Module):
@@ -251,9 +392,14 @@ class Embeddings(nn.Module):
         super(Embeddings, self).__init__()
         self.lut = nn.Embedding(vocab, d_model)
         self.d_model = d_model
+        self.scale = math.sqrt(d_model)
+        # fold the sqrt(d_model) scale into the table itself so forward is a
+        # plain lookup with no extra pass over (B, N, d_model)
+        with torch.no_grad():
+            self.lut.weight.mul_(self.scale)
 
     def forward(self, x):
-        return self.lut(x) * math.sqrt(self.d_model)
+        return self.lut(x)
 
 
 class PositionalEncoding(nn.Module):
@@ -274,44 +420,49 @@ class PositionalEncoding(nn.Module):
         self.register_buffer('pe', pe)
 
     def forward(self, x):
-        try:
-            x = x + Variable(self.pe[:, :x.size(1)], requires_grad=False)
-        except:
+        if x.dim() == 2:
+            # unbatched (N, d) input from the graph/video encoders
             x = x.unsqueeze(0)
-            x = x + Variable(self.pe[:, :x.size(1)], requires_grad=False)
+        x = x + self.pe[:, :x.size(1)]
         return self.dropout(x)
 
 
-def make_model(en_vocab, zh_vocab, N=6, d_model=512, d_ff=2048, h=8, dropout=0.1, share_classifier=False):
+def make_model(en_vocab, zh_vocab, N=6, d_model=512, d_ff=2048, h=8, dropout=0.1, share_classifier=False, compile_model=False):
+
+    # fresh modules come from factories instead of deepcopying prototypes:
+    # deepcopy walks the whole module tree per copy and is the slow part of
+    # model construction
+    def make_attn():
+        return MultiHeadedAttention(h, d_model)
+
+    def make_ff():
+        return PositionwiseFeedForward(d_model, d_ff, dropout)
 
-    c = copy.deepcopy
-    attn = MultiHeadedAttention(h, d_model)
-    ff = PositionwiseFeedForward(d_model, d_ff, dropout)
+    # stateless apart from its pe buffer, so a single instance (and a single
+    # max_len x d_model table) is shared by every user
     position = PositionalEncoding(d_model, dropout)
 
     en_generator = Generator(d_model, en_vocab)
     zh_generator = Generator(d_model, zh_vocab)
 
-    en_embed = [Embeddings(d_model, en_vocab), c(position)]
+    en_embed = [Embeddings(d_model, en_vocab), position]
     en_embed = nn.Sequential(*en_embed)
 
-    zh_embed = [Embeddings(d_model, zh_vocab), c(position)]
+    zh_embed = [Embeddings(d_model, zh_vocab), position]
     zh_embed = nn.Sequential(*zh_embed)
 
     # 构建分类器
     if share_classifier:
         classifier = nn.Linear(d_model, 401, bias=False)
     else:
-        en_classifier = nn.Linear(d_model, 401, bias=False).cuda()
-        zh_classifier = nn.Linear(d_model, 401, bias=False).cuda()
-        classifier = {'en': en_classifier, 'zh': zh_classifier}
+        classifier = ActionClassifier(d_model, 401)
 
-    encoder = Encoder(EncoderLayer(d_model, c(attn), c(attn), c(ff), dropout, c(attn), c(ff), classifier), N)
+    encoder = Encoder(EncoderLayer(d_model, make_attn(), make_attn(), make_ff(), dropout, make_attn(), make_ff(), classifier), N)
 
-    ff_layers = [nn.Linear(1024, d_model), nn.ReLU(), c(position)]
+    ff_layers = [nn.Linear(1024, d_model), nn.ReLU(), position]
     vid_encoder = nn.Sequential(*ff_layers)
 
-    decoder = Decoder(DecoderLayer(d_model, c(attn), c(attn), c(ff), dropout), N)
+    decoder = Decoder(DecoderLayer(d_model, make_attn(), make_attn(), make_ff(), dropout), N)
 
     model = EncoderDecoder(
         encoder=encoder,
@@ -325,6 +476,23 @@ def make_model(en_vocab, zh_vocab, N=6, d_model=512, d_ff=2048, h=8, dropout=0.1
 
     for p in model.parameters():
         if p.dim() > 1:
-            nn.init.xavier_uniform(p)
+            nn.init.xavier_uniform_(p)
+
+    # the xavier loop just overwrote the embedding tables, so re-fold the
+    # sqrt(d_model) scale the lookup no longer applies at runtime; likewise
+    # redo the classifier's per-direction init, which the loop clobbered with
+    # a 3-D fan rule
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, Embeddings):
+                m.lut.weight.mul_(m.scale)
+            elif isinstance(m, ActionClassifier):
+                m.reset_parameters()
+
+    if compile_model and hasattr(torch, 'compile'):
+        # Inductor fuses the FFN's relu/dropout into the surrounding GEMMs and
+        # strips Python overhead; dynamic=True avoids recompiles across the
+        # varying caption/video lengths.
+        model = torch.compile(model, dynamic=True)
 
     return model
@@ -100,7 +100,7 @@ def main(args):
     logging.info('train/val/test size: {}/{}/{}'.format(len(train_loader), len(val_loader), len(test_loader)))
 
     ## init model
-    model = make_model(len(vocab_en), len(vocab_zh), N=args.nb_blocks, d_model=args.d_model, d_ff=args.d_model * 4, h=args.att_h, dropout=args.dropout)
+    model = make_model(len(vocab_en), len(vocab_zh), N=args.nb_blocks, d_model=args.d_model, d_ff=args.d_model * 4, h=args.att_h, dropout=args.dropout, compile_model=getattr(args, 'compile', False))
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     model.to(device)
 
@@ -187,6 +187,10 @@ def train(train_loader, model, loss_compute, epoch, tok_zh, tok_en, act_label_lo
     model.train()
     total_tokens = 0
     total_loss = 0
+    # bf16 autocast: the GEMM-heavy forward runs in half precision (layernorm
+    # and softmax auto-upcast), while losses and backward stay fp32, so no
+    # GradScaler is needed
+    autocast = torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=getattr(args, 'amp', False))
     for (encap, zhcap), (ensrccap_mask, zhsrccap_mask), (zhtgt_mask, entgt_mask), video, video_mask, _, _, _, act_labels in tqdm(train_loader, desc="epoch {}/{}".format(epoch + 1, args.epochs)):
          
         encap, ensrccap_mask, entgt_mask, zhcap, zhsrccap_mask, zhtgt_mask = encap.cuda(), ensrccap_mask.cuda(), entgt_mask.cuda(), zhcap.cuda(), zhsrccap_mask.cuda(), zhtgt_mask.cuda()
@@ -196,7 +200,10 @@ def train(train_loader, model, loss_compute, epoch, tok_zh, tok_en, act_label_lo
         en_ntokens = (encap[:, 1:] != padding_idx).data.sum()
         ntokens = zh_ntokens + en_ntokens
 
-        out_en2zh, out_zh2en, en2zh_act_pred, zh2en_act_pred = model(encap, ensrccap_mask, entgt_mask, zhcap, zhsrccap_mask, zhtgt_mask, video, video_mask)
+        with autocast:
+            out_en2zh, out_zh2en, en2zh_act_pred, zh2en_act_pred = model(encap, ensrccap_mask, entgt_mask, zhcap, zhsrccap_mask, zhtgt_mask, video, video_mask)
+        out_en2zh, out_zh2en = out_en2zh.float(), out_zh2en.float()
+        en2zh_act_pred, zh2en_act_pred = en2zh_act_pred.float(), zh2en_act_pred.float()
 
         loss = loss_compute(out_en2zh, zhcap[:, 1:], zh_ntokens, out_zh2en, encap[:, 1:], en_ntokens)
 
@@ -222,7 +229,10 @@ def train(train_loader, model, loss_compute, epoch, tok_zh, tok_en, act_label_lo
             hypotheses_zh2en, hypotheses_zh2en_mask = tok_en.encode_encodings(hypotheses_zh2en)   # pseudo_en
 
             hypotheses_en2zh, hypotheses_en2zh_mask, hypotheses_zh2en, hypotheses_zh2en_mask = hypotheses_en2zh.long().cuda(), hypotheses_en2zh_mask.cuda(), hypotheses_zh2en.long().cuda(), hypotheses_zh2en_mask.cuda()
-            back_out_en2zh, back_out_zh2en, back_en2zh_act_pred, back_zh2en_act_pred = model(hypotheses_zh2en, hypotheses_zh2en_mask, entgt_mask, hypotheses_en2zh, hypotheses_en2zh_mask, zhtgt_mask, video, video_mask)
+            with autocast:
+                back_out_en2zh, back_out_zh2en, back_en2zh_act_pred, back_zh2en_act_pred = model(hypotheses_zh2en, hypotheses_zh2en_mask, entgt_mask, hypotheses_en2zh, hypotheses_en2zh_mask, zhtgt_mask, video, video_mask)
+            back_out_en2zh, back_out_zh2en = back_out_en2zh.float(), back_out_zh2en.float()
+            back_en2zh_act_pred, back_zh2en_act_pred = back_en2zh_act_pred.float(), back_zh2en_act_pred.float()
             backward_loss = loss_compute(back_out_zh2en, zhcap[:, 1:], zh_ntokens, back_out_en2zh, encap[:, 1:], en_ntokens)
 
             # task2: act_classifier
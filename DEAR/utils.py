@@ -16,6 +16,7 @@ eos_idx = base_vocab.index('<EOS>')
 unk_idx = base_vocab.index('<UNK>')
 
 import torch
+import torch.nn.functional as F
 
 
 def set_logger(log_path):
@@ -127,15 +128,18 @@ class Tokenizer(object):
             encoding += [self.word_to_index['<PAD>']] * (self.encoding_length-len(encoding))
         cap = torch.from_numpy(np.array(encoding[:self.encoding_length]))
 
-        captgt_mask = self.make_std_mask(cap[:-1], self.word_to_index['<PAD>']).squeeze(0)
-        capsrc_mask = (cap != self.word_to_index['<PAD>']).unsqueeze(-2)
+        # masks leave the tokenizer already in attention broadcast shape --
+        # (1, N, N) causal target, (1, 1, N) source -- so the attention layers
+        # do no per-call unsqueeze
+        captgt_mask = self.make_std_mask(cap[:-1], self.word_to_index['<PAD>'])
+        capsrc_mask = (cap != self.word_to_index['<PAD>']).unsqueeze(-2).unsqueeze(-2)
 
         return cap, capsrc_mask, captgt_mask, length
 
     def encode_encodings(self, encodings):
 
         caps = torch.zeros([len(encodings), self.encoding_length])
-        capsrc_masks = torch.zeros([len(encodings), 1, self.encoding_length])
+        capsrc_masks = torch.zeros([len(encodings), 1, 1, self.encoding_length], dtype=torch.bool)
 
         for i, encoding in enumerate(encodings):
             if len(encoding) > self.encoding_length - 2:
@@ -149,7 +153,7 @@ class Tokenizer(object):
             caps[i] = cap
 
             # source mask
-            capsrc_mask = (cap != self.word_to_index['<PAD>']).unsqueeze(-2)
+            capsrc_mask = (cap != self.word_to_index['<PAD>']).unsqueeze(-2).unsqueeze(-2)
             capsrc_masks[i] = capsrc_mask
 
         return caps, capsrc_masks
@@ -262,10 +266,22 @@ class SimpleLossCompute:
         self.opt = opt
 
     def __call__(self, x_e2z, y_e2z, norm_e2z, x_z2e=None, y_z2e=None, norm_z2e=None, max_len=40):
-        zh_out = self.zh_generator(x_e2z)
-        loss_en2zh = self.criterion_en2zh(zh_out.contiguous().view(-1, zh_out.size(-1)), y_e2z.contiguous().view(-1)) / norm_e2z.float()
-        en_out = self.en_generator(x_z2e)
-        loss_zh2en = self.criterion_zh2en(en_out.contiguous().view(-1, en_out.size(-1)), y_z2e.contiguous().view(-1)) / norm_z2e.float()
+        # cross_entropy on the raw logits fuses log-softmax and NLL into one
+        # kernel pass over the (B*N, vocab) activation; smoothing and padding
+        # come from the LabelSmoothing criteria so configs stay the source of
+        # truth
+        zh_out = self.zh_generator.inference(x_e2z)
+        loss_en2zh = F.cross_entropy(zh_out.contiguous().view(-1, zh_out.size(-1)),
+                                    y_e2z.contiguous().view(-1),
+                                    ignore_index=self.criterion_en2zh.padding_idx,
+                                    label_smoothing=self.criterion_en2zh.smoothing,
+                                    reduction='sum') / norm_e2z.float()
+        en_out = self.en_generator.inference(x_z2e)
+        loss_zh2en = F.cross_entropy(en_out.contiguous().view(-1, en_out.size(-1)),
+                                    y_z2e.contiguous().view(-1),
+                                    ignore_index=self.criterion_zh2en.padding_idx,
+                                    label_smoothing=self.criterion_zh2en.smoothing,
+                                    reduction='sum') / norm_z2e.float()
 
         loss = loss_en2zh + loss_zh2en
         return loss
@@ -311,7 +327,7 @@ def generate_tgt(x, generator, max_len=40):
 def beam_search_decode(model, src, src_mask, video, video_mask, max_len, start_symbol, unk_symbol, end_symbol, pad_symbol, beam=5, penalty=1.0,
                        nbest=5, min_len=1, type='en2zh'):
     query, query_mask = src, src_mask
-    query_memory, _  = model.encode(query, query_mask, video, video_mask, type=type)
+    query_memory, query_mask = model.encode_once(query, query_mask, video, video_mask, type=type)
 
     ds = torch.ones(1, 1).fill_(start_symbol).type_as(query.data)
     hyplist = [([], 0., ds)]
@@ -321,7 +337,7 @@ def beam_search_decode(model, src, src_mask, video, video_mask, max_len, start_s
         new_hyplist = []
         argmin = 0
         for out, lp, st in hyplist:
-            output = model.decode(query_memory, query_mask, st,
+            output = model.decode_step(query_memory, query_mask, st,
                                   subsequent_mask(st.size(1)).type_as(query.data), type=type)
             if type == 'en2zh':
                 logp = model.zh_generator(output[:, -1])
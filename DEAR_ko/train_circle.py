@@ -100,7 +100,7 @@ def main(args):
     logging.info('train/val/test size: {}/{}/{}'.format(len(train_loader), len(val_loader), len(test_loader)))
 
     ## init model
-    model = make_model(len(vocab_en), len(vocab_ko), N=args.nb_blocks, d_model=args.d_model, d_ff=args.d_model * 4, h=args.att_h, dropout=args.dropout)
+    model = make_model(len(vocab_en), len(vocab_ko), N=args.nb_blocks, d_model=args.d_model, d_ff=args.d_model * 4, h=args.att_h, dropout=args.dropout, compile_model=getattr(args, 'compile', False))
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     model.to(device)
 
@@ -187,6 +187,10 @@ def train(train_loader, model, loss_compute, epoch, tok_ko, tok_en, act_label_lo
     model.train()
     total_tokens = 0
     total_loss = 0
+    # bf16 autocast: the GEMM-heavy forward runs in half precision (layernorm
+    # and softmax auto-upcast), while losses and backward stay fp32, so no
+    # GradScaler is needed
+    autocast = torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=getattr(args, 'amp', False))
     for (encap, kocap), (ensrccap_mask, kosrccap_mask), (kotgt_mask, entgt_mask), video, video_mask, _, _, _, act_labels in tqdm(train_loader, desc="epoch {}/{}".format(epoch + 1, args.epochs)):
          
         encap, ensrccap_mask, entgt_mask, kocap, kosrccap_mask, kotgt_mask = encap.cuda(), ensrccap_mask.cuda(), entgt_mask.cuda(), kocap.cuda(), kosrccap_mask.cuda(), kotgt_mask.cuda()
@@ -196,7 +200,10 @@ def train(train_loader, model, loss_compute, epoch, tok_ko, tok_en, act_label_lo
         en_ntokens = (encap[:, 1:] != padding_idx).data.sum()
         ntokens = ko_ntokens + en_ntokens
 
-        out_en2ko, out_ko2en, en2ko_act_pred, ko2en_act_pred = model(encap, ensrccap_mask, entgt_mask, kocap, kosrccap_mask, kotgt_mask, video, video_mask)
+        with autocast:
+            out_en2ko, out_ko2en, en2ko_act_pred, ko2en_act_pred = model(encap, ensrccap_mask, entgt_mask, kocap, kosrccap_mask, kotgt_mask, video, video_mask)
+        out_en2ko, out_ko2en = out_en2ko.float(), out_ko2en.float()
+        en2ko_act_pred, ko2en_act_pred = en2ko_act_pred.float(), ko2en_act_pred.float()
 
         loss = loss_compute(out_en2ko, kocap[:, 1:], ko_ntokens, out_ko2en, encap[:, 1:], en_ntokens)
 
@@ -222,7 +229,10 @@ def train(train_loader, model, loss_compute, epoch, tok_ko, tok_en, act_label_lo
             hypotheses_ko2en, hypotheses_ko2en_mask = tok_en.encode_encodings(hypotheses_ko2en)   # pseudo_en
 
             hypotheses_en2ko, hypotheses_en2ko_mask, hypotheses_ko2en, hypotheses_ko2en_mask = hypotheses_en2ko.long().cuda(), hypotheses_en2ko_mask.cuda(), hypotheses_ko2en.long().cuda(), hypotheses_ko2en_mask.cuda()
-            back_out_en2ko, back_out_ko2en, back_en2ko_act_pred, back_ko2en_act_pred = model(hypotheses_ko2en, hypotheses_ko2en_mask, entgt_mask, hypotheses_en2ko, hypotheses_en2ko_mask, kotgt_mask, video, video_mask)
+            with autocast:
+                back_out_en2ko, back_out_ko2en, back_en2ko_act_pred, back_ko2en_act_pred = model(hypotheses_ko2en, hypotheses_ko2en_mask, entgt_mask, hypotheses_en2ko, hypotheses_en2ko_mask, kotgt_mask, video, video_mask)
+            back_out_en2ko, back_out_ko2en = back_out_en2ko.float(), back_out_ko2en.float()
+            back_en2ko_act_pred, back_ko2en_act_pred = back_en2ko_act_pred.float(), back_ko2en_act_pred.float()
             backward_loss = loss_compute(back_out_ko2en, kocap[:, 1:], ko_ntokens, back_out_en2ko, encap[:, 1:], en_ntokens)
 
             # task2: act_classifier
@@ -12,6 +12,7 @@ from konlpy.tag import Mecab
 mecab = Mecab()
 
 import torch
+import torch.nn.functional as F
 
 # padding, unknown word, end of sentence
 base_vocab = ['<PAD>', '<UNK>', '<SOS>', '<EOS>']
@@ -129,8 +130,11 @@ class Tokenizer(object):
             encoding += [self.word_to_index['<PAD>']] * (self.encoding_length-len(encoding))
         cap = torch.from_numpy(np.array(encoding[:self.encoding_length]))
 
-        captgt_mask = self.make_std_mask(cap[:-1], self.word_to_index['<PAD>']).squeeze(0)
-        capsrc_mask = (cap != self.word_to_index['<PAD>']).unsqueeze(-2)
+        # masks leave the tokenizer already in attention broadcast shape --
+        # (1, N, N) causal target, (1, 1, N) source -- so the attention layers
+        # do no per-call unsqueeze
+        captgt_mask = self.make_std_mask(cap[:-1], self.word_to_index['<PAD>'])
+        capsrc_mask = (cap != self.word_to_index['<PAD>']).unsqueeze(-2).unsqueeze(-2)
 
         return cap, capsrc_mask, captgt_mask, length
 
@@ -138,7 +142,7 @@ class Tokenizer(object):
     def encode_encodings(self, encodings):
 
         caps = torch.zeros([len(encodings), self.encoding_length])
-        capsrc_masks = torch.zeros([len(encodings), 1, self.encoding_length])
+        capsrc_masks = torch.zeros([len(encodings), 1, 1, self.encoding_length], dtype=torch.bool)
 
         for i, encoding in enumerate(encodings):
             if len(encoding) > self.encoding_length - 2:
@@ -152,7 +156,7 @@ class Tokenizer(object):
             caps[i] = cap
 
             # source mask
-            capsrc_mask = (cap != self.word_to_index['<PAD>']).unsqueeze(-2)
+            capsrc_mask = (cap != self.word_to_index['<PAD>']).unsqueeze(-2).unsqueeze(-2)
             capsrc_masks[i] = capsrc_mask
 
         return caps, capsrc_masks
@@ -267,10 +271,22 @@ class SimpleLossCompute:
         self.opt = opt
 
     def __call__(self, x_e2z, y_e2z, norm_e2z, x_z2e=None, y_z2e=None, norm_z2e=None, max_len=40):
-        ko_out = self.ko_generator(x_e2z)
-        loss_en2ko = self.criterion_en2ko(ko_out.contiguous().view(-1, ko_out.size(-1)), y_e2z.contiguous().view(-1)) / norm_e2z.float()
-        en_out = self.en_generator(x_z2e)
-        loss_ko2en = self.criterion_ko2en(en_out.contiguous().view(-1, en_out.size(-1)), y_z2e.contiguous().view(-1)) / norm_z2e.float()
+        # cross_entropy on the raw logits fuses log-softmax and NLL into one
+        # kernel pass over the (B*N, vocab) activation; smoothing and padding
+        # come from the LabelSmoothing criteria so configs stay the source of
+        # truth
+        ko_out = self.ko_generator.inference(x_e2z)
+        loss_en2ko = F.cross_entropy(ko_out.contiguous().view(-1, ko_out.size(-1)),
+                                    y_e2z.contiguous().view(-1),
+                                    ignore_index=self.criterion_en2ko.padding_idx,
+                                    label_smoothing=self.criterion_en2ko.smoothing,
+                                    reduction='sum') / norm_e2z.float()
+        en_out = self.en_generator.inference(x_z2e)
+        loss_ko2en = F.cross_entropy(en_out.contiguous().view(-1, en_out.size(-1)),
+                                    y_z2e.contiguous().view(-1),
+                                    ignore_index=self.criterion_ko2en.padding_idx,
+                                    label_smoothing=self.criterion_ko2en.smoothing,
+                                    reduction='sum') / norm_z2e.float()
 
         loss = loss_en2ko + loss_ko2en
         return loss
@@ -316,7 +332,7 @@ def generate_tgt(x, generator, max_len=40):
 def beam_search_decode(model, src, src_mask, video, video_mask, max_len, start_symbol, unk_symbol, end_symbol, pad_symbol, beam=5, penalty=1.0,
                        nbest=5, min_len=1, type='en2ko'):
     query, query_mask = src, src_mask
-    query_memory, _  = model.encode(query, query_mask, video, video_mask, type=type)
+    query_memory, query_mask = model.encode_once(query, query_mask, video, video_mask, type=type)
 
     ds = torch.ones(1, 1).fill_(start_symbol).type_as(query.data)
     hyplist = [([], 0., ds)]
@@ -326,7 +342,7 @@ def beam_search_decode(model, src, src_mask, video, video_mask, max_len, start_s
         new_hyplist = []
         argmin = 0
         for out, lp, st in hyplist:
-            output = model.decode(query_memory, query_mask, st,
+            output = model.decode_step(query_memory, query_mask, st,
                                   subsequent_mask(st.size(1)).type_as(query.data), type=type)
             if type == 'en2ko':
                 logp = model.ko_generator(output[:, -1])
@@ -111,7 +111,7 @@ def main(args):
     # vocab = vocab_src + vocab_tgt
 
     ## init model
-    model = make_model(len(vocab_src), len(vocab_tgt), N=args.nb_blocks, d_model=args.d_model, d_ff=args.d_model*4, h=args.att_h, dropout=args.dropout, GCN_layer=args.GCN_layer)
+    model = make_model(len(vocab_src), len(vocab_tgt), N=args.nb_blocks, d_model=args.d_model, d_ff=args.d_model*4, h=args.att_h, dropout=args.dropout, GCN_layer=args.GCN_layer, compile_model=getattr(args, 'compile', False))
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     model.to(device)
 
@@ -195,13 +195,19 @@ def train(train_loader, model, loss_compute, epoch):
     total_tokens = 0
     total_loss = 0
     tokens = 0
+    # bf16 autocast: the GEMM-heavy forward runs in half precision (layernorm
+    # and softmax auto-upcast), while losses and backward stay fp32, so no
+    # GradScaler is needed
+    autocast = torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=getattr(args, 'amp', False))
     for src, src_mask, video, trg, trg_mask, _, _, _ in tqdm(train_loader, desc="epoch {}/{}".format(epoch + 1, args.epochs)):
 
         src, src_mask, video, trg, trg_mask = src.cuda(), src_mask.cuda(), (video[0].cuda(), video[1].cuda()), trg.cuda(), trg_mask.cuda()
 
         ntokens = (trg[:, 1:] != padding_idx).data.sum()
 
-        out = model(src, src_mask, video, trg[:, :-1], trg_mask)
+        with autocast:
+            out = model(src, src_mask, video, trg[:, :-1], trg_mask)
+        out = out.float()
         ntokens_query = (src != padding_idx).data.sum()
 
         loss, _, _ = loss_compute(out, trg[:, 1:], ntokens, None, src, ntokens_query)
@@ -4,7 +4,6 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.utils.weight_norm import weight_norm
 import math, copy, time
-from torch.autograd import Variable
 
 class EncoderDecoder(nn.Module):
     def __init__(self, query_encoder, vid_graph_encoder, decoder, query_embed, tgt_embed, generator):
@@ -22,6 +21,10 @@ class EncoderDecoder(nn.Module):
         self.generator = generator
 
     def forward(self, src, src_mask, fts, trg, trg_mask):
+        # Normalize the masks to boolean once here instead of evaluating
+        # `mask == 0` inside every attention call.
+        src_mask, trg_mask = src_mask != 0, trg_mask != 0
+
         encoded_output = self.encode(src, src_mask, fts)
         return self.decode(encoded_output, src_mask, trg, trg_mask)
 
@@ -37,6 +40,23 @@ class EncoderDecoder(nn.Module):
         output = self.query_encoder(self.query_embed(query), query_mask, vid_graph_output)
         return output
 
+    def encode_once(self, src, src_mask, vid=None):
+        "Encode the source once so a generate loop can cache the memory."
+        memory = self.encode(src, src_mask, vid)
+        return memory, src_mask
+
+    def decode_step(self, memory, src_mask, tgt_tokens, tgt_mask, past_kvs=None, use_cache=False):
+        "Run one decoding step against a cached encoder memory."
+        if use_cache:
+            encoded_tgt = self.tgt_embed(tgt_tokens)
+            if past_kvs is not None:
+                # earlier positions live in the cached K/V, so only the newest
+                # token runs through the decoder; the causal mask is implied
+                encoded_tgt = encoded_tgt[:, -1:]
+                tgt_mask = None
+            return self.decoder(encoded_tgt, memory, src_mask, tgt_mask, past_kvs=past_kvs, use_cache=True)
+        return self.decode(memory, src_mask, tgt_tokens, tgt_mask)
+
     def decode(self, query_memory, query_mask, tgt, tgt_mask):
         encoded_tgt = self.tgt_embed(tgt)
         return self.decoder(encoded_tgt, query_memory, query_mask, tgt_mask)
@@ -76,19 +96,11 @@ class Encoder(nn.Module):
         return self.norm(x)
 
 
-class LayerNorm(nn.Module):
-    "Construct a layernorm module"
+class LayerNorm(nn.LayerNorm):
+    "Layernorm backed by the fused aten kernel, keeping the transformer eps."
 
     def __init__(self, features, eps=1e-6):
-        super(LayerNorm, self).__init__()
-        self.a_2 = nn.Parameter(torch.ones(features))
-        self.b_2 = nn.Parameter(torch.zeros(features))
-        self.eps = eps
-
-    def forward(self, x):
-        mean = x.mean(-1, keepdim=True)
-        std = x.std(-1, keepdim=True)
-        return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
+        super(LayerNorm, self).__init__(features, eps=eps)
 
 
 class SublayerConnection(nn.Module):
@@ -106,8 +118,9 @@ class SublayerConnection(nn.Module):
         return x + self.dropout(sublayer(self.norm(x)))
 
     def expand_forward(self, x, sublayer):
-        out = self.dropout(sublayer(self.norm(x)))
-        out = out.mean(1).unsqueeze(1).expand_as(x)
+        # (B, 1, C) broadcasts against x in the add; expand_as only forced
+        # the intermediate to be materialized at full (B, N, C) size
+        out = self.dropout(sublayer(self.norm(x))).mean(1, keepdim=True)
         return x + out
 
     def nosum_forward(self, x, sublayer):
@@ -130,18 +143,21 @@ class EncoderLayer(nn.Module):
         self.size = size
 
     def forward(self, seq, seq_mask, vid_ft):
-        count = 0
-        # vid_ft = self.sublayer[count](vid_ft, lambda vid_ft: self.vid_self_attn(vid_ft, vid_ft, vid_ft))
-        # count += 1
-        vid_ft = self.sublayer[count](vid_ft, self.vid_ff)
-        count += 1
-
-        seq = self.sublayer[count](seq, lambda seq: self.self_attn(seq, seq, seq, seq_mask))
-        count += 1
-        seq = self.sublayer[count](seq, self.ff1)
-
-        vid_seq = self.sublayer[count](seq, lambda seq: self.vid_attn(seq, vid_ft, vid_ft))    # torch.Size([2, 40, 512]) 即视频给文本上attention
-        count += 1
+        # bind the sublayers once; ModuleList.__getitem__ costs add up at
+        # several lookups per layer per step
+        sub0, sub1, sub2, sub3 = self.sublayer[:4]
+        # vid_ft = sub0(vid_ft, lambda vid_ft: self.vid_self_attn(vid_ft, vid_ft, vid_ft))
+        vid_ft = sub0(vid_ft, self.vid_ff)
+
+        # residuals are written out instead of handing lambdas to the
+        # sublayer: no closure allocation per call, and both torch.compile
+        # and TorchScript can see through the calls
+        h = sub1.norm(seq)
+        seq = seq + sub1.dropout(self.self_attn(h, h, h, seq_mask))
+        seq = sub2(seq, self.ff1)
+
+        h = sub2.norm(seq)
+        vid_seq = seq + sub2.dropout(self.vid_attn(h, vid_ft, vid_ft))    # torch.Size([2, 40, 512]) 即视频给文本上attention
 
         return vid_seq
 
@@ -152,7 +168,14 @@ class Decoder(nn.Module):
         self.layers = clones(layer, N)
         self.norm = LayerNorm(layer.size)
 
-    def forward(self, x, query_memory, query_mask, tgt_mask):
+    def forward(self, x, query_memory, query_mask, tgt_mask, past_kvs=None, use_cache=False):
+        if use_cache:
+            presents = []
+            for i, layer in enumerate(self.layers):
+                past = past_kvs[i] if past_kvs is not None else None
+                x, present = layer(x, query_memory, query_mask, tgt_mask, past_kv=past, use_cache=True)
+                presents.append(present)
+            return self.norm(x), presents
         for layer in self.layers:
             x = layer(x, query_memory, query_mask, tgt_mask)
         return self.norm(x)
@@ -167,21 +190,40 @@ class DecoderLayer(nn.Module):
         self.feed_forward = feed_forward
         self.sublayer = clones(SublayerConnection(size, dropout), 3)
 
-    def forward(self, x, q_memory, q_mask, tgt_mask):
-        count = 0
-        x = self.sublayer[count](x, lambda x: self.self_attn(x, x, x, tgt_mask))
-        count += 1
-        x = self.sublayer[count](x, lambda x: self.src_attn(x, q_memory, q_memory, q_mask))
-        count += 1
-        return self.sublayer[count](x, self.feed_forward)
+    def forward(self, x, q_memory, q_mask, tgt_mask, past_kv=None, use_cache=False):
+        sub0, sub1, sub2 = self.sublayer
+        if use_cache:
+            self_past = past_kv[0] if past_kv is not None else None
+            src_past = past_kv[1] if past_kv is not None else None
+
+            h = sub0.norm(x)
+            out, self_present = self.self_attn(h, h, h, tgt_mask, cache=self_past, use_cache=True)
+            x = x + sub0.dropout(out)
+
+            h = sub1.norm(x)
+            out, src_present = self.src_attn(h, q_memory, q_memory, q_mask, cache=src_past, use_cache=True)
+            x = x + sub1.dropout(out)
 
+            return sub2(x, self.feed_forward), (self_present, src_present)
 
-def attention(query, key, value, mask=None, dropout=None, time_weighting=None, T=None):
+        h = sub0.norm(x)
+        x = x + sub0.dropout(self.self_attn(h, h, h, tgt_mask))
+        h = sub1.norm(x)
+        x = x + sub1.dropout(self.src_attn(h, q_memory, q_memory, q_mask))
+        return sub2(x, self.feed_forward)
+
+
+def attention(query, key, value, mask=None, dropout=None, time_weighting=None, T=None, scale=None, neg_inf=None):
     "Compute 'Scaled Dot Product Attention'"
-    d_k = query.size(-1)
-    scores = torch.matmul(query, key.transpose(-2, -1)) / math.sqrt(d_k)
+    if scale is None:
+        scale = 1.0 / math.sqrt(query.size(-1))
+    scores = torch.matmul(query, key.transpose(-2, -1)).mul_(scale)
     if mask is not None:
-        scores = scores.masked_fill(mask == 0, -1e9)
+        # mask is already boolean (True = attend); fill in place so no fresh
+        # score tensor is allocated
+        if neg_inf is None:
+            neg_inf = scores.new_tensor(-1e9)
+        scores.masked_fill_(~mask, neg_inf)
     p_attn = F.softmax(scores, dim=-1)
 
     # time_weighting
@@ -202,22 +244,37 @@ class MultiHeadedAttention(nn.Module):
         self.d_k = d_model // h
         self.d_model = d_model
         self.h = h
+        # hoisted out of the per-call path; sqrt is cheap but this also keeps
+        # the eager fallback free of python-float churn inside the hot loop
+        self.inv_sqrt_dk = 1.0 / math.sqrt(self.d_k)
         if d_in < 0:
             d_in = d_model
-        self.linears = clones(nn.Linear(d_in, d_model), 3)
-        self.linears.append(nn.Linear(d_model, d_in))
+        # fused projection for self-attn; separate q and fused kv for cross-attn
+        self.qkv = nn.Linear(d_in, 3 * d_model)
+        self.q = nn.Linear(d_in, d_model)
+        self.kv = nn.Linear(d_in, 2 * d_model)
+        self.out = nn.Linear(d_model, d_in)
         self.attn = None
         self.dropout = nn.Dropout(p=dropout)
+        # scalar fill value for masked scores, allocated once and moved with
+        # the module instead of being rebuilt from the python float per call;
+        # kept at -1e9 (not -inf) so fully-masked rows still softmax to a
+        # uniform distribution instead of NaN
+        self.register_buffer('neg_inf', torch.tensor(-1e9), persistent=False)
 
         # trick
         # self.time_shift = nn.ZeroPad2d((0, 0, 1, 0))
         # self.time_weighting = nn.Parameter(torch.ones(self.h, 128, 128))
 
-    def forward(self, query, key, value, mask=None):
+    def forward(self, query, key, value, mask=None, cache=None, use_cache=False):
         "Implements Figure 2"
         if mask is not None:
-            # Same mask applied to all h heads.
-            mask = mask.unsqueeze(1)
+            # Masks arrive from the loader already in broadcast shape,
+            # (B, 1, 1, N) or (B, 1, N, N); callers that bypass
+            # EncoderDecoder.forward may still hand us a 0/1 mask, so
+            # normalize to boolean here at most once.
+            if mask.dtype != torch.bool:
+                mask = mask != 0
         nbatches, qT, qC = query.size()
         # _, kT, kC = key.size()
         # _, vT, vC = value.size()
@@ -227,20 +284,61 @@ class MultiHeadedAttention(nn.Module):
         # key = torch.cat([self.time_shift(key)[:, :kT, :kC//2], key[:, :kT, kC//2:]], dim=2)
         # value = torch.cat([self.time_shift(value)[:, :vT, :vC // 2], value[:, :vT, vC // 2:]], dim=2)
 
-        # 1) Do all the linear projections in batch from d_model => h x d_k
-        query, key, value = \
-            [l(x).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
-             for l, x in zip(self.linears, (query, key, value))]
-
-        # 2) Apply attention on all the projected vectors in batch.
+        # 1) Do all the linear projections in batch from d_model => h x d_k.
+        # Self-attention projects q/k/v with one big GEMM; cross-attn (key is
+        # always value at our call sites) fuses only the k/v projections.
+        present = None
+        if key is query and value is query:
+            qkv = self.qkv(query).view(nbatches, -1, 3, self.h, self.d_k).permute(2, 0, 3, 1, 4)
+            query, key, value = qkv[0], qkv[1], qkv[2]
+            if use_cache:
+                if cache is not None:
+                    # append the new positions' K/V to the cached prefix
+                    key = torch.cat([cache[0], key], dim=2)
+                    value = torch.cat([cache[1], value], dim=2)
+                present = (key, value)
+        elif use_cache and cache is not None:
+            # cross-attention K/V are static across decode steps
+            query = self.q(query).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
+            key, value = cache
+            present = cache
+        else:
+            query = self.q(query).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
+            key, value = [t.view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
+                          for t in self.kv(key).chunk(2, dim=-1)]
+            if use_cache:
+                present = (key, value)
+
+        # 2) Apply attention on all the projected vectors in batch. On CUDA
+        # this dispatches to the fused flash/mem-efficient kernels and never
+        # materializes the (B, h, N, N) score matrix; the eager attention()
+        # path is kept for CPU eval and still records self.attn.
         # trick : 加入　qT　和　time-weighting
         # x, self.attn = attention(query, key, value, mask=mask, dropout=self.dropout, time_weighting=self.time_weighting, T=qT)
-        x, self.attn = attention(query, key, value, mask=mask, dropout=self.dropout)
+        if query.is_cuda:
+            # hand SDPA an additive float mask rather than the raw bool one:
+            # a bool mask fills dropped positions with -inf, which turns a
+            # fully-masked row (the encoding path emits all-zero masks) into
+            # NaN, while -1e9 softmaxes it to uniform like the eager path
+            attn_mask = None
+            if mask is not None:
+                attn_mask = torch.zeros_like(mask, dtype=query.dtype)
+                attn_mask.masked_fill_(~mask, self.neg_inf)
+            x = F.scaled_dot_product_attention(
+                query, key, value,
+                attn_mask=attn_mask,
+                dropout_p=self.dropout.p if self.training else 0.0)
+        else:
+            x, self.attn = attention(query, key, value, mask=mask, dropout=self.dropout, scale=self.inv_sqrt_dk, neg_inf=self.neg_inf)
 
-        # 3) "Concat" using a view and apply a final linear.
-        x = x.transpose(1, 2).contiguous() \
-            .view(nbatches, -1, self.h * self.d_k)
-        return self.linears[-1](x)
+        # 3) Project straight out of the (B, h, N, d_k) layout: einsum with a
+        # head-split view of the output weight replaces transpose+contiguous
+        # (a full copy of the attention output) followed by the Linear.
+        x = torch.einsum('bhnd,ehd->bne',
+                         x, self.out.weight.view(-1, self.h, self.d_k)) + self.out.bias
+        if use_cache:
+            return x, present
+        return x
 
 
 class PositionwiseFeedForward(nn.Module):
@@ -263,9 +361,14 @@ class Embeddings(nn.Module):
         super(Embeddings, self).__init__()
         self.lut = nn.Embedding(vocab, d_model)
         self.d_model = d_model
+        self.scale = math.sqrt(d_model)
+        # fold the sqrt(d_model) scale into the table itself so forward is a
+        # plain lookup with no extra pass over (B, N, d_model)
+        with torch.no_grad():
+            self.lut.weight.mul_(self.scale)
 
     def forward(self, x):
-        return self.lut(x) * math.sqrt(self.d_model)
+        return self.lut(x)
 
 
 class PositionalEncoding(nn.Module):
@@ -286,11 +389,10 @@ class PositionalEncoding(nn.Module):
         self.register_buffer('pe', pe)
 
     def forward(self, x):
-        try:
-            x = x + Variable(self.pe[:, :x.size(1)], requires_grad=False)
-        except:
+        if x.dim() == 2:
+            # unbatched (N, d) input from the graph/video encoders
             x = x.unsqueeze(0)
-            x = x + Variable(self.pe[:, :x.size(1)], requires_grad=False)
+        x = x + self.pe[:, :x.size(1)]
         return self.dropout(x)
 
 
@@ -349,30 +451,38 @@ class VGraphEncoder(nn.Module):
         return v_output
 
 
-def make_model(src_vocab, tgt_vocab, N=6, d_model=512, d_ff=2048, h=8, dropout=0.1, GCN_layer=3, co_attn=False):
+def make_model(src_vocab, tgt_vocab, N=6, d_model=512, d_ff=2048, h=8, dropout=0.1, GCN_layer=3, co_attn=False, compile_model=False):
+
+    # fresh modules come from factories instead of deepcopying prototypes:
+    # deepcopy walks the whole module tree per copy and is the slow part of
+    # model construction
+    def make_attn():
+        return MultiHeadedAttention(h, d_model)
+
+    def make_ff():
+        return PositionwiseFeedForward(d_model, d_ff, dropout)
 
-    c = copy.deepcopy
-    attn = MultiHeadedAttention(h, d_model)
-    ff = PositionwiseFeedForward(d_model, d_ff, dropout)
+    # stateless apart from its pe buffer, so a single instance (and a single
+    # max_len x d_model table) is shared by every user
     position = PositionalEncoding(d_model, dropout)
     generator = Generator(d_model, tgt_vocab)
-    query_embed = [Embeddings(d_model, src_vocab), c(position)]
-    tgt_embed = [Embeddings(d_model, tgt_vocab), c(position)]
+    query_embed = [Embeddings(d_model, src_vocab), position]
+    tgt_embed = [Embeddings(d_model, tgt_vocab), position]
     query_embed = nn.Sequential(*query_embed)
     tgt_embed = nn.Sequential(*tgt_embed)
 
 
     """graph"""
     vid_graph_encoder = VGraphEncoder(556, 556, GCN_layer, d_model, dropout)
-    vid_self_attn = c(attn)
-    vid_attn = c(attn)
+    vid_self_attn = make_attn()
+    vid_attn = make_attn()
 
     if co_attn:
-        query_encoder = Encoder(EncoderLayer(d_model, c(attn), vid_self_attn, vid_attn, c(ff), c(ff), dropout, c(attn)), N)
+        query_encoder = Encoder(EncoderLayer(d_model, make_attn(), vid_self_attn, vid_attn, make_ff(), make_ff(), dropout, make_attn()), N)
     else:
-        query_encoder = Encoder(EncoderLayer(d_model, c(attn), vid_self_attn, vid_attn, c(ff), c(ff), dropout), N)
+        query_encoder = Encoder(EncoderLayer(d_model, make_attn(), vid_self_attn, vid_attn, make_ff(), make_ff(), dropout), N)
 
-    decoder = Decoder(DecoderLayer(d_model, c(attn), c(attn), c(ff), dropout), N)
+    decoder = Decoder(DecoderLayer(d_model, make_attn(), make_attn(), make_ff(), dropout), N)
 
     model = EncoderDecoder(
         query_encoder=query_encoder,
@@ -384,6 +494,19 @@ def make_model(src_vocab, tgt_vocab, N=6, d_model=512, d_ff=2048, h=8, dropout=0
 
     for p in model.parameters():
         if p.dim() > 1:
-            nn.init.xavier_uniform(p)
+            nn.init.xavier_uniform_(p)
+
+    # the xavier loop just overwrote the embedding tables, so re-fold the
+    # sqrt(d_model) scale the lookup no longer applies at runtime
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, Embeddings):
+                m.lut.weight.mul_(m.scale)
+
+    if compile_model and hasattr(torch, 'compile'):
+        # Inductor fuses the FFN's relu/dropout into the surrounding GEMMs and
+        # strips Python overhead; dynamic=True avoids recompiles across the
+        # varying caption/video lengths.
+        model = torch.compile(model, dynamic=True)
 
     return model
@@ -10,6 +10,7 @@ import logging
 import pandas as pd
 
 import torch
+import torch.nn.functional as F
 
 from konlpy.tag import Mecab
 mecab = Mecab()
@@ -133,10 +134,13 @@ class Tokenizer(object):
             encoding += [self.word_to_index['<PAD>']] * (self.encoding_length-len(encoding))
         cap = torch.from_numpy(np.array(encoding[:self.encoding_length]))
 
+        # masks leave the tokenizer already in attention broadcast shape --
+        # (1, N, N) causal target, (1, 1, N) source -- so the attention layers
+        # do no per-call unsqueeze
         if flag == 'TRG':
-            cap_mask = self.make_std_mask(cap[:-1], self.word_to_index['<PAD>']).squeeze(0)
+            cap_mask = self.make_std_mask(cap[:-1], self.word_to_index['<PAD>'])
         else:
-            cap_mask = (cap != self.word_to_index['<PAD>']).unsqueeze(-2)  # src
+            cap_mask = (cap != self.word_to_index['<PAD>']).unsqueeze(-2).unsqueeze(-2)  # src
 
         return cap, cap_mask, length
 
@@ -268,25 +272,38 @@ class SimpleLossCompute:
         else:
             scores, pred_lengths = None, None
 
-        out = self.generator(x)
-        loss = self.criterion(out.contiguous().view(-1, out.size(-1)),
-                              y.contiguous().view(-1)) / norm.float()
+        # cross_entropy on the raw logits fuses log-softmax and NLL into one
+        # kernel pass over the (B*N, vocab) activation; smoothing and padding
+        # come from the LabelSmoothing criterion so configs stay the source of
+        # truth
+        out = self.generator.inference(x)
+        loss = F.cross_entropy(out.contiguous().view(-1, out.size(-1)),
+                               y.contiguous().view(-1),
+                               ignore_index=self.criterion.padding_idx,
+                               label_smoothing=self.criterion.smoothing,
+                               reduction='sum') / norm.float()
         if ae_x is not None:
             if type(ae_x) == list:
                 for i, ae_in in enumerate(ae_x):
                     if self.ae_generator is not None:
-                        ae_out = self.ae_generator[i](ae_in)
+                        ae_out = self.ae_generator[i].inference(ae_in)
                     else:
-                        ae_out = self.generator(ae_in)
-                    loss += self.l * self.criterion(ae_out.contiguous().view(-1, ae_out.size(-1)),
-                                                    ae_y.contiguous().view(-1)) / ae_norm.float()
+                        ae_out = self.generator.inference(ae_in)
+                    loss += self.l * F.cross_entropy(ae_out.contiguous().view(-1, ae_out.size(-1)),
+                                                     ae_y.contiguous().view(-1),
+                                                     ignore_index=self.criterion.padding_idx,
+                                                     label_smoothing=self.criterion.smoothing,
+                                                     reduction='sum') / ae_norm.float()
             else:
                 if self.ae_generator is not None:
-                    ae_out = self.ae_generator(ae_x)
+                    ae_out = self.ae_generator.inference(ae_x)
                 else:
-                    ae_out = self.generator(ae_x)
-                loss += self.l * self.criterion(ae_out.contiguous().view(-1, ae_out.size(-1)),
-                                                ae_y.contiguous().view(-1)) / ae_norm.float()
+                    ae_out = self.generator.inference(ae_x)
+                loss += self.l * F.cross_entropy(ae_out.contiguous().view(-1, ae_out.size(-1)),
+                                                 ae_y.contiguous().view(-1),
+                                                 ignore_index=self.criterion.padding_idx,
+                                                 label_smoothing=self.criterion.smoothing,
+                                                 reduction='sum') / ae_norm.float()
 
         if self.opt is not None:   # train
             loss.backward()
@@ -306,7 +323,7 @@ def subsequent_mask(size):
 def beam_search_decode(model, src, src_mask, video, max_len, start_symbol, unk_symbol, end_symbol, pad_symbol, beam=5, penalty=0.5,
                        nbest=5, min_len=1):
     video_features, query, query_mask = video, src, src_mask
-    query_memory = model.encode(query, query_mask, video_features)
+    query_memory, query_mask = model.encode_once(query, query_mask, video_features)
 
     ds = torch.ones(1, 1).fill_(start_symbol).type_as(query.data)
     hyplist = [([], 0., ds)]
@@ -316,7 +333,7 @@ def beam_search_decode(model, src, src_mask, video, max_len, start_symbol, unk_s
         new_hyplist = []
         argmin = 0
         for out, lp, st in hyplist:
-            output = model.decode(query_memory, query_mask, st, subsequent_mask(st.size(1)).type_as(query.data))
+            output = model.decode_step(query_memory, query_mask, st, subsequent_mask(st.size(1)).type_as(query.data))
             if type(output) == tuple or type(output) == list:
                 logp = model.generator(output[0][:, -1])
             else: